@@ -1,8 +1,17 @@
 import os
+import glob
 import json
+import math
+import hashlib
+import asyncio
+import contextlib
+import itertools
+import threading
+import tempfile
 import subprocess
+import concurrent.futures
 import tkinter as tk
-from tkinter import messagebox, filedialog
+from tkinter import ttk, messagebox, filedialog
 from tkinterdnd2 import DND_FILES, TkinterDnD
 
 # ==============================
@@ -12,73 +21,382 @@ CONFIG_FILE = "config.json"
 
 def load_config():
     """ config.json を読み込み、辞書を返す。存在しなければ空の辞書を返す。 """
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"設定ファイルの読み込みに失敗: {e}")
-    return {}
+    try:
+        # バイト列のまま json.loads に渡す（UTF-8 は json が直接解釈する）
+        with open(CONFIG_FILE, 'rb') as f:
+            return json.loads(f.read())
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"設定ファイルの読み込みに失敗: {e}")
+        return {}
+
+SAVE_DELAY_MS = 500           # 設定変更から書き込みまでの待ち時間（ミリ秒）
+_save_pending = False         # 書き込みが予約済みかどうか
+_last_saved_digest = None     # 最後に書き込んだ内容のハッシュ
 
 def save_config(data):
-    """ 辞書を config.json に書き込む """
+    """ 辞書を config.json に書き込む。前回書き込んだ内容と同じなら何もしない """
+    global _last_saved_digest
     try:
-        with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        content = json.dumps(data, ensure_ascii=False, indent=2).encode('utf-8')
+        digest = hashlib.blake2b(content).digest()
+        if digest == _last_saved_digest:
+            return
+        # 一時ファイルに書いてから置き換え、書き込み途中で壊れないようにする
+        temp_file = CONFIG_FILE + ".tmp"
+        with open(temp_file, 'wb') as f:
+            f.write(content)
+        os.replace(temp_file, CONFIG_FILE)
+        _last_saved_digest = digest
     except Exception as e:
         print(f"設定ファイルの書き込みに失敗: {e}")
 
+def schedule_save():
+    """ 設定の保存を予約する。短時間に続いた変更は1回の書き込みにまとめる """
+    global _save_pending
+    if not _save_pending:
+        _save_pending = True
+        root.after(SAVE_DELAY_MS, _flush_config)
+
+def _flush_config():
+    """ 予約された設定の保存を実行する """
+    global _save_pending
+    _save_pending = False
+    save_config(config)
+
 # ==============================
 # FFmpeg関連の定数や関数
 # ==============================
 TARGET_SIZE_MB = 9.2          # ターゲットファイルサイズ（MB）
 AUDIO_BITRATE = 128000        # オーディオビットレート (bps)
+CONTAINER_OVERHEAD_BPS = 1000 # MP4コンテナのオーバーヘッド見込み (bps)
+BITRATE_SAFETY_MARGIN = 0.98  # サイズ超過を防ぐための安全係数
+MODES = ["360p", "480p", "720p", "9.5MB"]  # 出力モード
+NVENC_PRESETS = ["p1", "p2", "p3", "p4", "p5", "p6", "p7"]  # p1が最速、p7が最高画質（=slow）
+DEFAULT_NVENC_PRESET = "p5"
+
+PASSTHROUGH_SAMPLE_RATES = (44100, 48000)  # リサンプリングせずにそのまま使うサンプルレート
+FAST_SCALE_RATIO = 1.5        # 短辺がこの倍率を超えて縮小される場合だけ fast_bilinear を使う
+MAX_CONCURRENT_JOBS = max(1, (os.cpu_count() or 2) // 2)  # 同時に実行するエンコード数の上限（CPUコア数の半分）
+# NVENCを使うジョブの同時実行数の上限。1ジョブで出力ごとにセッションを開くため、
+# GeForceのセッション数制限を超えないよう1件ずつ実行する
+MAX_NVENC_JOBS = 1
+# NVDEC（GPUデコード）に任せる映像コーデックとピクセルフォーマット。古いGPUでもデコードできるものに限る
+# それ以外（MPEG-4 Part 2、10bit、ProRes など）はCPUでデコードする
+NVDEC_CODECS = ("h264", "hevc", "mpeg1video", "mpeg2video", "vc1")
+NVDEC_PIX_FMTS = ("yuv420p", "yuvj420p", "nv12")
+# ストリームコピーでMP4に格納できるコーデック（PCMやVorbisなどはMP4に入らないので再エンコードする）
+MP4_COPY_VIDEO_CODECS = ("h264", "hevc", "av1")
+MP4_COPY_AUDIO_CODECS = ("aac", "mp3", "opus")
+
+PROBE_CACHE_SIZE = 128        # ffprobe結果のキャッシュ件数
+PROBE_INFO_LENGTH = 7         # キャッシュする項目数（項目を変えたら古いキャッシュは使わない）
+probe_cache = {}              # "パス|更新日時|サイズ" -> [duration, width, height, sample_rate, video_codec, pix_fmt, audio_codec]（config.json に保存）
+
+def get_cached_video_info(path, mtime_ns, size):
+    """
+    (パス, 更新日時, サイズ) をキーに、キャッシュ済みの動画情報を返す。なければ None を返す。
+    見つかったエントリは末尾へ移し、最近使ったものほど削除されにくくする（LRU）
+    """
+    key = f"{path}|{mtime_ns}|{size}"
+    cached = probe_cache.get(key)
+    if cached is not None and len(cached) == PROBE_INFO_LENGTH:
+        probe_cache[key] = probe_cache.pop(key)
+        schedule_save()
+        return tuple(cached)
+    return None
+
+def cache_video_info(path, mtime_ns, size, video_info):
+    """
+    動画情報をキャッシュに登録し、config.json への保存を予約する
+    """
+    # 同じパスの古いエントリ（ファイルが更新されたもの）は無効なので削除
+    for old_key in [k for k in probe_cache if k.rsplit("|", 2)[0] == path]:
+        del probe_cache[old_key]
+    probe_cache[f"{path}|{mtime_ns}|{size}"] = list(video_info)
+    while len(probe_cache) > PROBE_CACHE_SIZE:
+        del probe_cache[next(iter(probe_cache))]
+    schedule_save()
 
-def get_video_duration(filename):
+def probe_video(path):
     """
-    ffprobeを使って動画の再生時間（秒）を取得する
+    ffprobeを1回だけ実行し、動画の再生時間（秒）、解像度、音声のサンプルレート、映像のコーデックとピクセルフォーマット、音声のコーデックを取得する
+    戻り値は (duration, width, height, sample_rate, video_codec, pix_fmt, audio_codec)。
+    音声がない場合 sample_rate と audio_codec は None。
+    動画として読み込めない場合は ValueError を送出する。
+    UIを止めないようワーカースレッドで実行するため、キャッシュやUIには触れない
+    """
+    result = subprocess.run(
+        [
+            "ffprobe", "-v", "error",
+            "-show_entries", "stream=codec_type,codec_name,width,height,pix_fmt,sample_rate:format=duration",
+            "-of", "json",
+            path
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        detail = result.stderr.decode('utf-8', 'replace').strip()
+        raise ValueError(f"ファイルを読み込めませんでした。動画ファイルか確認してください。\n{detail}")
+    # 出力は ASCII のみなので、ロケール依存のテキストモードを使わず自前でデコードする
+    info = json.loads(result.stdout.decode('ascii', 'replace'))
+    streams = info.get("streams", [])
+    # 最初の映像ストリームと音声ストリームを使う
+    video = next((s for s in streams if s.get("codec_type") == "video"), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None:
+        raise ValueError("映像ストリームが見つかりません。動画ファイルを指定してください。")
+    if "duration" not in info.get("format", {}):
+        raise ValueError("動画の再生時間を取得できませんでした。")
+    sample_rate = int(audio["sample_rate"]) if audio and "sample_rate" in audio else None
+    audio_codec = audio.get("codec_name") if audio else None
+    return (float(info["format"]["duration"]), int(video["width"]), int(video["height"]), sample_rate,
+            video.get("codec_name"), video.get("pix_fmt"), audio_codec)
+
+def detect_encoders():
+    """
+    FFmpegが h264_nvenc と libfdk_aac エンコーダに対応しているかを調べる
+    戻り値は (has_nvenc, has_fdk_aac)。
+    FFmpegのバージョンが前回と同じなら、config.json に保存した結果をそのまま使う
     """
     try:
-        result = subprocess.run(
-            [
-                "ffprobe", "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "format=duration",
-                "-of", "default=noprint_wrappers=1:nokey=1",
-                filename
-            ],
+        version = subprocess.run(
+            ["ffmpeg", "-version"],
             stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        duration = float(result.stdout.strip())
-        return duration
-    except Exception as e:
-        messagebox.showerror("エラー", f"動画の長さ取得に失敗しました:\n{e}")
-        return None
+            stderr=subprocess.DEVNULL
+        ).stdout
+    except OSError as e:
+        print(f"FFmpegのバージョン取得に失敗: {e}")
+        return False, False
+    version_hash = hashlib.blake2b(version, digest_size=16).hexdigest()
+    if (config.get('encoder_probe_version') == version_hash
+            and 'has_nvenc' in config and 'has_fdk_aac' in config):
+        return config['has_nvenc'], config['has_fdk_aac']
+
+    # エンコーダ一覧の取得は遅いので、FFmpegが更新されたときだけ実行する
+    encoders = subprocess.run(
+        ["ffmpeg", "-hide_banner", "-encoders"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL
+    ).stdout.decode('ascii', 'replace')
+    has_nvenc = "h264_nvenc" in encoders
+    has_fdk_aac = "libfdk_aac" in encoders
+    config['has_nvenc'] = has_nvenc
+    config['has_fdk_aac'] = has_fdk_aac
+    config['encoder_probe_version'] = version_hash
+    config.pop('nvenc_probe_version', None)  # 旧バージョンのキー
+    save_config(config)
+    return has_nvenc, has_fdk_aac
+
+def get_scale_size(mode, vertical):
+    """
+    出力モードに応じた scale フィルタのサイズ (W:H) を返す
+    """
+    if mode == "9.5MB":
+        # 解像度変更 480p
+        return "480:-1" if vertical else "854:480"
+    # 縦長の場合は高さ固定、横幅は自動調整（-1:固定値）
+    if vertical:
+        presets = {"360p": "360:-1", "480p": "480:-1", "720p": "720:-1"}
+    else:
+        # 横長の場合のプリセット例
+        presets = {"360p": "640:360", "480p": "854:480", "720p": "1280:720"}
+    return presets[mode]
 
-def get_video_resolution(filename):
+def get_target_short_side(mode):
     """
-    ffprobeを使って動画の解像度 (widthxheight) を取得する
+    出力モードの短辺の長さ（ピクセル）を返す
     """
+    return 480 if mode == "9.5MB" else int(mode.rstrip("p"))
+
+def can_use_nvdec(video_codec, pix_fmt):
+    """
+    元動画をNVDECでデコードし、GPU上のままリサイズできるかを返す
+    """
+    return video_codec in NVDEC_CODECS and pix_fmt in NVDEC_PIX_FMTS
+
+def get_scale_filter(mode, vertical, use_nvenc, gpu_decode, fast_scale):
+    """
+    出力モードに応じたリサイズのフィルタチェーンを返す
+    scale は表示アスペクト比が保たれるよう出力のSARを調整するため、setsar は付けない
+    fast_scale が True の場合は、CPUでのリサイズに fast_bilinear を使う
+    """
+    size = get_scale_size(mode, vertical)
+    if gpu_decode:
+        # GPU上でリサイズする。NVDECの出力（NV12）はNVENCがそのまま受け取れるので変換しない
+        return f"scale_cuda={size}"
+    # 暗黙の変換フィルタが挿入されないよう、ピクセルフォーマットまで明示する
+    # NVENCへはNV12で渡すと、エンコーダ側での変換が不要になる
+    # 大きく縮小する場合は fast_bilinear でも見た目はほぼ変わらず、bicubic より高速
+    # 拡大や小さな縮小では折り返しノイズが目立つので、既定のスケーラーを使う
+    pix_fmt = "nv12" if use_nvenc else "yuv420p"
+    flags = ":flags=fast_bilinear" if fast_scale else ""
+    return f"scale={size}{flags},format={pix_fmt}"
+
+def can_stream_copy(mode, width, height, file_size, video_codec, audio_codec):
+    """
+    元動画がすでに出力モードの条件を満たしていて、再エンコードせずにコピーできるかを返す
+    """
+    # コピーするのは最初の映像・音声ストリームだけ。音声がない場合は映像だけ判定する
+    if video_codec not in MP4_COPY_VIDEO_CODECS:
+        return False
+    if audio_codec is not None and audio_codec not in MP4_COPY_AUDIO_CODECS:
+        return False
+    if mode == "9.5MB":
+        return file_size <= TARGET_SIZE_MB * 1000 * 1000
+    # 解像度指定モードは短辺が指定の解像度と一致していればよい
+    return min(width, height) == int(mode.rstrip("p"))
+
+# ==============================
+# FFmpeg引数のテンプレート
+# ==============================
+# {kbps} {maxrate} {bufsize} {passlogfile} {preset} は実行時に fill_args で埋める
+# ターゲットビットレートと、複雑なシーンでの跳ね上がりを抑える上限
+RATE_ARGS = ("-b:v", "{kbps}k", "-maxrate", "{maxrate}k", "-bufsize", "{bufsize}k")
+# libx264 のスレッド設定。短い動画でも全コアを使えるよう、フレーム並列ではなくスライス並列にする
+X264_THREAD_ARGS = (
+    "-threads", "0",
+    "-x264-params", "sliced-threads=1:rc-lookahead=40"
+)
+
+# (NVENC使用, ビットレート指定) -> 1つの出力に対する映像エンコーダの引数
+_ENC_ARGS = {
+    # 解像度指定モードはCRF（品質指定）でエンコード
+    (False, False): ("-c:v", "libx264", "-preset", "slow", "-crf", "23", *X264_THREAD_ARGS),
+    # NVENCの場合、-cq を使用（値は例として23）。-b:v 0 で品質指定のみにする
+    (True, False): ("-c:v", "h264_nvenc", "-preset", "{preset}", "-tune", "hq",
+                    "-rc", "vbr", "-cq", "23", "-b:v", "0"),
+    # ビットレート指定モード（2パスVBR）。低スペック端末でも再生が軽くなるよう fastdecode を指定する
+    (False, True): (*RATE_ARGS, "-c:v", "libx264", "-preset", "slow", "-tune", "fastdecode", *X264_THREAD_ARGS,
+                    "-pass", "2", "-passlogfile", "{passlogfile}"),
+    # NVENCは1コマンド内で2パスエンコードできる
+    (True, True): (*RATE_ARGS, "-c:v", "h264_nvenc", "-preset", "{preset}", "-tune", "hq",
+                   "-rc", "vbr", "-multipass", "fullres"),
+}
+
+# 2パス目の前に実行する解析用の1パス目（libx264、9.5MB用）
+PASS1_ARGS = (
+    *RATE_ARGS,
+    "-c:v", "libx264", "-preset", "medium", "-tune", "fastdecode", *X264_THREAD_ARGS,
+    "-pass", "1", "-passlogfile", "{passlogfile}",
+    "-an", "-f", "mp4"
+)
+
+# (モード, NVENC使用, GPUデコード, 高速リサイズ, 縦長) -> (リサイズのフィルタチェーン, 映像エンコーダの引数)
+# 組み合わせは起動時にすべて作っておき、エンコード時は値を埋めるだけにする
+TEMPLATES = {
+    (mode, use_nvenc, gpu_decode, fast_scale, vertical): (
+        get_scale_filter(mode, vertical, use_nvenc, gpu_decode, fast_scale),
+        _ENC_ARGS[(use_nvenc, mode == "9.5MB")]
+    )
+    for mode in MODES
+    # GPUデコードはNVENC使用時のみ
+    for use_nvenc, gpu_decode in ((False, False), (True, False), (True, True))
+    for fast_scale in (False, True)
+    for vertical in (False, True)
+}
+
+def fill_args(templates, values):
+    """
+    引数テンプレートのプレースホルダを値で埋めたタプルを返す
+    """
+    return tuple(arg.format(**values) for arg in templates)
+
+# ==============================
+# エンコードジョブの非同期実行
+# ==============================
+# UIを止めないよう、FFmpegはバックグラウンドスレッドのイベントループ上で実行する
+encode_loop = asyncio.new_event_loop()
+encode_semaphore = asyncio.Semaphore(MAX_CONCURRENT_JOBS)
+nvenc_semaphore = asyncio.Semaphore(MAX_NVENC_JOBS)
+# ffprobeはUIスレッドを止めないよう、別スレッドで1件ずつ実行する
+probe_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+PROBE_POLL_MS = 200           # ffprobeの完了を確認する間隔（ミリ秒）
+job_counter = itertools.count()
+job_progress = {}  # ジョブID -> 進捗（0.0〜1.0）。UIスレッドからのみ更新する
+active_outputs = set()  # 実行中のジョブが書き込む出力ファイルのパス。UIスレッドからのみ更新する
+running_processes = set()  # 実行中のFFmpegプロセス。イベントループのスレッドからのみ更新する
+shutting_down = False      # 終了処理中はUIへ通知せず、新しいコマンドも実行しない
+SHUTDOWN_TIMEOUT = 5          # 終了時にFFmpegの停止を待つ秒数
+
+async def encode_job(job_id, command_groups, duration, output_paths, passlogfile=None, use_nvenc=False):
+    """
+    FFmpegのコマンドを順番に非同期実行し、-progress の出力から進捗をUIへ通知する
+    command_groups はコマンド列のリスト。同じ列のコマンドは前のコマンドが失敗したら実行しないが、
+    別の列（再エンコードとストリームコピー）は互いの失敗に関係なく実行する
+    2パスエンコードの場合は1つの列に1パス目と2パス目が順に入っている
+    use_nvenc が True のジョブは、CPU側の上限に加えてNVENC用の上限でも同時実行数を制限する
+    """
+    errors = []
+    total = sum(len(commands) for commands in command_groups)
+    index = 0
     try:
-        result = subprocess.run(
-            [
-                "ffprobe", "-v", "error",
-                "-select_streams", "v:0",
-                "-show_entries", "stream=width,height",
-                "-of", "csv=p=0:s=x",
-                filename
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        resolution = result.stdout.strip()
-        return resolution
+        async with contextlib.AsyncExitStack() as stack:
+            # 取得する順番を常に同じにして、ジョブ同士が互いを待ち続けないようにする
+            if use_nvenc:
+                await stack.enter_async_context(nvenc_semaphore)
+            await stack.enter_async_context(encode_semaphore)
+            for commands in command_groups:
+                for command in commands:
+                    if shutting_down:
+                        break
+                    try:
+                        process = await asyncio.create_subprocess_exec(
+                            *command,
+                            stdin=asyncio.subprocess.DEVNULL,
+                            stdout=asyncio.subprocess.PIPE
+                        )
+                        running_processes.add(process)
+                        try:
+                            if shutting_down:
+                                process.terminate()
+                            async for line in process.stdout:
+                                key, _, value = line.decode("ascii", "replace").strip().partition("=")
+                                if key == "out_time_us" and value.isdigit() and not shutting_down:
+                                    fraction = min(int(value) / (duration * 1000000), 1.0)
+                                    root.after(0, update_progress, job_id, (index + fraction) / total)
+                            returncode = await process.wait()
+                        finally:
+                            running_processes.discard(process)
+                    except OSError as e:
+                        errors.append(e)
+                        break
+                    if returncode != 0:
+                        errors.append(subprocess.CalledProcessError(returncode, command))
+                        break
+                    index += 1
     except Exception as e:
-        messagebox.showerror("エラー", f"動画の解像度取得に失敗しました:\n{e}")
-        return "unknown"
+        errors.append(e)
+    finally:
+        # 2パスエンコードのログファイル（*-0.log, *-0.log.mbtree）を削除
+        if passlogfile:
+            for log_file in glob.glob(f"{glob.escape(passlogfile)}-*.log*"):
+                try:
+                    os.remove(log_file)
+                except OSError:
+                    pass
+    if shutting_down:
+        return
+    error = "\n".join(str(e) for e in errors) if errors else None
+    root.after(0, finish_job, job_id, error, output_paths)
+
+async def stop_all_jobs():
+    """
+    終了時に実行中のFFmpegを停止し、終わるまで待つ。待ちきれなければ強制終了する
+    """
+    global shutting_down
+    shutting_down = True
+    processes = list(running_processes)
+    for process in processes:
+        process.terminate()
+    try:
+        await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processes)), SHUTDOWN_TIMEOUT)
+    except asyncio.TimeoutError:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
 
 # ==============================
 # UI用の関数
@@ -107,12 +425,70 @@ def browse_output_dir():
         output_dir_entry.insert(0, directory)
         # 設定ファイルに保存
         config['last_output_dir'] = directory
-        save_config(config)
+        schedule_save()
 
 def toggle_nvenc():
     """ NVENC使用チェックの状態を保存 """
     config['use_nvenc'] = use_nvenc_var.get()
-    save_config(config)
+    schedule_save()
+
+def change_nvenc_preset(preset):
+    """ NVENCプリセットの選択を保存 """
+    config['nvenc_preset'] = preset
+    schedule_save()
+
+def toggle_force_reencode():
+    """ 強制再エンコードチェックの状態を保存 """
+    config['force_reencode'] = force_reencode_var.get()
+    schedule_save()
+
+def on_close():
+    """
+    ウィンドウを閉じる前に、実行中のジョブを止めて保存待ちの設定を書き込む
+    FFmpegの停止はイベントループ上で行い、UIを止めないよう完了を root.after で待つ
+    """
+    if job_progress:
+        if not messagebox.askyesno("確認", "エンコード中のジョブがあります。中断して終了しますか？"):
+            return
+        future = asyncio.run_coroutine_threadsafe(stop_all_jobs(), encode_loop)
+        status_label.config(text="終了しています...")
+        root.after(PROBE_POLL_MS, check_shutdown, future)
+        return
+    if _save_pending:
+        _flush_config()
+    root.destroy()
+
+def check_shutdown(future):
+    """ FFmpegの停止が終わったらウィンドウを閉じる """
+    if not future.done():
+        root.after(PROBE_POLL_MS, check_shutdown, future)
+        return
+    if _save_pending:
+        _flush_config()
+    root.destroy()
+
+def update_progress(job_id, fraction):
+    """ ジョブの進捗を記録し、実行中ジョブ全体の平均をプログレスバーに反映する """
+    job_progress[job_id] = fraction
+    progress_bar["value"] = sum(job_progress.values()) / len(job_progress) * 100
+    status_label.config(text=f"エンコード中... ({len(job_progress)}件)")
+
+def finish_job(job_id, error, output_paths):
+    """ ジョブ終了時に進捗表示を更新し、結果を通知する """
+    job_progress.pop(job_id, None)
+    active_outputs.difference_update(output_paths)
+    if job_progress:
+        progress_bar["value"] = sum(job_progress.values()) / len(job_progress) * 100
+        status_label.config(text=f"エンコード中... ({len(job_progress)}件)")
+    else:
+        progress_bar["value"] = 0
+        status_label.config(text="待機中")
+
+    if error is None:
+        output_list = "\n".join(output_paths)
+        messagebox.showinfo("完了", f"動画の圧縮が完了しました。\n出力ファイル:\n{output_list}")
+    else:
+        messagebox.showerror("エラー", f"変換中にエラーが発生しました。\n{error}")
 
 def run_ffmpeg():
     """ FFmpegを実行して動画をエンコードする """
@@ -124,46 +500,53 @@ def run_ffmpeg():
         messagebox.showerror("エラー", "指定されたファイルが存在しません。")
         return
 
-    # 動画の再生時間を取得
-    duration = get_video_duration(input_file)
-    if duration is None:
+    # 動画の再生時間と解像度を取得（縦長かどうかの判定にも使う）
+    # キャッシュになければ、ffprobeをワーカースレッドで実行して完了を待つ
+    try:
+        stat = os.stat(input_file)
+    except OSError as e:
+        messagebox.showerror("エラー", f"動画情報の取得に失敗しました:\n{e}")
+        return
+    probe_key = (os.path.abspath(input_file), stat.st_mtime_ns, stat.st_size)
+    video_info = get_cached_video_info(*probe_key)
+    if video_info is not None:
+        start_encode(input_file, video_info)
+        return
+
+    # 取得中に同じファイルが二重に登録されないよう、ボタンを無効化しておく
+    encode_button.config(state=tk.DISABLED)
+    future = probe_pool.submit(probe_video, probe_key[0])
+    root.after(PROBE_POLL_MS, check_probe, future, input_file, probe_key)
+
+def check_probe(future, input_file, probe_key):
+    """ ffprobeの完了を確認し、終わっていればエンコードを開始する """
+    if not future.done():
+        root.after(PROBE_POLL_MS, check_probe, future, input_file, probe_key)
+        return
+    encode_button.config(state=tk.NORMAL)
+    try:
+        video_info = future.result()
+    except Exception as e:
+        messagebox.showerror("エラー", f"動画情報の取得に失敗しました:\n{e}")
         return
+    cache_video_info(*probe_key, video_info)
+    start_encode(input_file, video_info)
 
-    # NVENC使用の有無をチェック
+def start_encode(input_file, video_info):
+    """ 動画情報をもとにFFmpegのコマンドを組み立て、エンコードジョブを登録する """
+    duration, orig_width, orig_height, source_sample_rate, video_codec, pix_fmt, audio_codec = video_info
+    vertical = orig_width < orig_height
+    short_side = min(orig_width, orig_height)
+
+    # NVENC使用の有無とプリセットを取得
     use_nvenc = use_nvenc_var.get()
+    nvenc_preset = nvenc_preset_var.get()
 
-    # ラジオボタンで選択されたモードを取得
-    mode = mode_var.get()  # "360p", "480p", "720p" または "9.5MB"
-    # 縦長かどうかを判定するため、元の解像度を取得
-    orig_res = get_video_resolution(input_file)
-    if orig_res != "unknown":
-        orig_width, orig_height = map(int, orig_res.split("x"))
-        vertical = orig_width < orig_height
-    else:
-        vertical = False
-
-    if mode in ["360p", "480p", "720p"]:
-        # 縦長の場合は高さ固定、横幅は自動調整（-1:固定値）
-        if vertical:
-            presets = {"360p": "360:-1", "480p": "480:-1", "720p": "720:-1"}
-        else:
-            # 横長の場合のプリセット例
-            presets = {"360p": "640:360", "480p": "854:480", "720p": "1280:720"}
-        scaling_filter = f"scale={presets[mode]}"
-        resolution_str = mode
-        use_bitrate = False  # 解像度指定モードはCRF（品質指定）でエンコード
-    elif mode == "9.5MB":
-        if vertical:
-            scaling_filter =  f"scale=480:-1" # 解像度変更 480p
-        else:
-            scaling_filter =  f"scale=854:480"
-
-        resolution_str = mode
-        use_bitrate = True   # ビットレート指定モード
-    else:
-        scaling_filter = None
-        resolution_str = "default"
-        use_bitrate = False
+    # チェックボックスで選択されたモードを取得（複数選択可）
+    selected_modes = [mode for mode, var in mode_vars.items() if var.get()]
+    if not selected_modes:
+        messagebox.showerror("エラー", "出力設定を1つ以上選択してください。")
+        return
 
     # 出力先フォルダを取得
     output_dir = output_dir_entry.get().strip()
@@ -173,65 +556,167 @@ def run_ffmpeg():
         messagebox.showerror("エラー", f"指定された出力先フォルダが存在しません。\n{output_dir}")
         return
 
-    # 出力ファイル名は「元ファイル名_解像度.mp4」
-    base_name = os.path.splitext(os.path.basename(input_file))[0]
-    output_file = os.path.join(output_dir, f"{base_name}_{resolution_str}.mp4")
-
-    # FFmpegコマンドの組み立て
-    command = ["ffmpeg", "-i", input_file]
-    if scaling_filter:
-        command.extend(["-vf", scaling_filter])
+    # 条件を満たしている出力は再エンコードせず、ストリームコピーで済ませる
+    if force_reencode_var.get():
+        encode_modes = selected_modes
+        copy_modes = []
+    else:
+        file_size = os.path.getsize(input_file)
+        copy_modes = [
+            m for m in selected_modes
+            if can_stream_copy(m, orig_width, orig_height, file_size, video_codec, audio_codec)
+        ]
+        encode_modes = [m for m in selected_modes if m not in copy_modes]
 
-    if use_bitrate:
+    video_bitrate_kbps = 0
+    if "9.5MB" in encode_modes:
         # ターゲットファイルサイズに合わせたビットレートの計算
         target_size_bits = TARGET_SIZE_MB * 1000 * 1000* 8 #1024から1000に変更
         audio_total_bits = AUDIO_BITRATE * duration
-        video_total_bits = target_size_bits - audio_total_bits
+        overhead_total_bits = CONTAINER_OVERHEAD_BPS * duration
+        video_total_bits = target_size_bits - audio_total_bits - overhead_total_bits
         if video_total_bits <= 0:
             messagebox.showerror("エラー", "動画の長さが長すぎるか、ターゲットサイズが小さすぎます。")
             return
         video_bitrate_bps = video_total_bits / duration
-        video_bitrate_kbps = int(video_bitrate_bps / 1000)
+        # 安全係数を掛けた上で切り捨て、ターゲットサイズを超えないようにする
+        video_bitrate_kbps = math.floor(video_bitrate_bps / 1000 * BITRATE_SAFETY_MARGIN)
         if video_bitrate_kbps <= 0:
             messagebox.showerror("エラー", "計算されたビットレートが不正です。")
             return
 
-        if use_nvenc:
-            command.extend(["-b:v", f"{video_bitrate_kbps}k", "-c:v", "h264_nvenc", "-preset", "slow"])
-        else:
-            command.extend(["-b:v", f"{video_bitrate_kbps}k", "-c:v", "libx264", "-preset", "slow"])
+    job_id = next(job_counter)
+    commands = []
+    passlogfile = None
+    if "9.5MB" in encode_modes and not use_nvenc:
+        passlogfile = os.path.join(tempfile.gettempdir(), f"movieenc_{os.getpid()}_{job_id}")
+    values = {
+        "kbps": video_bitrate_kbps,
+        "maxrate": math.floor(video_bitrate_kbps * 1.2),
+        "bufsize": video_bitrate_kbps * 2,
+        "passlogfile": passlogfile,
+        "preset": nvenc_preset
+    }
+    if passlogfile:
+        # libx264 の場合は2パスエンコードでターゲットサイズに収める
+        # 1パス目は解析のみ行い、映像は破棄する（音声も不要）
+        fast_scale = short_side > get_target_short_side("9.5MB") * FAST_SCALE_RATIO
+        scale_filter, _ = TEMPLATES[("9.5MB", False, False, fast_scale, vertical)]
+        commands.append((
+            "ffmpeg", "-progress", "pipe:1", "-nostats", "-y",
+            "-i", input_file,
+            "-vf", scale_filter,
+            *fill_args(PASS1_ARGS, values),
+            os.devnull
+        ))
+
+    # NVDECが対応していない動画はCPUでデコードし、NVENCにはシステムメモリから渡す
+    gpu_decode = use_nvenc and bool(encode_modes) and can_use_nvdec(video_codec, pix_fmt)
+    if gpu_decode:
+        # NVDECでデコードし、フレームをGPUメモリ上に置いたままリサイズ・エンコードする
+        hwaccel_args = ("-hwaccel", "cuda", "-hwaccel_output_format", "cuda", "-extra_hw_frames", "8")
     else:
-        # CRF（品質指定）でエンコード
-        if use_nvenc:
-            # NVENCの場合、-cq を使用（値は例として23）
-            command.extend(["-c:v", "h264_nvenc", "-preset", "slow", "-cq", "23"])
-        else:
-            command.extend(["-c:v", "libx264", "-preset", "slow", "-crf", "23"])
-
-    # 共通のオーディオ設定
-    command.extend([
-        "-c:a", "aac",
-        "-b:a", "128k",
-        "-ar" ,"44100",
-        output_file
-    ])
+        hwaccel_args = ()
 
-    try:
-        subprocess.run(command, check=True)
-        messagebox.showinfo("完了", f"動画の圧縮が完了しました。\n出力ファイル:\n{output_file}")
-    except subprocess.CalledProcessError as e:
-        messagebox.showerror("エラー", f"変換中にエラーが発生しました。\n{e}")
+    # デコードは1回だけ行い、split で各出力に分配してからリサイズする
+    count = len(encode_modes)
+    if count > 1:
+        labels = [f"[v{i}]" for i in range(count)]
+        filters = [f"[0:v]split={count}" + "".join(labels)]
+    else:
+        labels = ["[0:v]"]
+        filters = []
+    templates = [
+        TEMPLATES[(mode, use_nvenc, gpu_decode, short_side > get_target_short_side(mode) * FAST_SCALE_RATIO, vertical)]
+        for mode in encode_modes
+    ]
+    for i, (scale_filter, _) in enumerate(templates):
+        filters.append(f"{labels[i]}{scale_filter}[o{i}]")
+
+    # 音声は libfdk_aac が使えればそちらを使い、サンプルレートは必要なときだけ変換する
+    audio_codec = "libfdk_aac" if has_fdk_aac else "aac"
+    if source_sample_rate is None or source_sample_rate in PASSTHROUGH_SAMPLE_RATES:
+        resample_args = ()
+    else:
+        resample_args = ("-ar", "44100")
+
+    # 出力ファイル名は「元ファイル名_解像度.mp4」
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    output_files = {mode: os.path.join(output_dir, f"{base_name}_{mode}.mp4") for mode in selected_modes}
+    # 同じファイルへ書き込むジョブが実行中なら登録しない（ボタンの連打などで二重に登録されるのを防ぐ）
+    busy_files = [path for path in output_files.values() if path in active_outputs]
+    if busy_files:
+        messagebox.showerror("エラー", "同じ出力ファイルへのエンコードが実行中です。\n" + "\n".join(busy_files))
+        return
+    # FFmpegは標準入力を使わないので、上書きの確認はここで行い -y を渡す
+    existing_files = [path for path in output_files.values() if os.path.exists(path)]
+    if existing_files and not messagebox.askyesno(
+            "確認", "出力ファイルがすでに存在します。上書きしますか？\n" + "\n".join(existing_files)):
+        return
+
+    # FFmpegコマンドの組み立て（進捗は key=value 形式で標準出力に書き出させる）
+    command_groups = []
+    if encode_modes:
+        commands.append((
+            "ffmpeg", "-progress", "pipe:1", "-nostats", "-y",
+            *hwaccel_args,
+            "-i", input_file,
+            "-filter_complex", ";".join(filters),
+            *(
+                arg
+                for i, mode in enumerate(encode_modes)
+                for arg in (
+                    # 音声は最初の1トラックだけ（ビットレート計算も1トラック分で行っている）
+                    "-map", f"[o{i}]", "-map", "0:a:0?",
+                    *fill_args(templates[i][1], values),
+                    # 共通のオーディオ設定（moov atomを先頭に置き、ダウンロード途中から再生できるようにする）
+                    "-c:a", audio_codec, "-b:a", "128k", *resample_args,
+                    "-movflags", "+faststart",
+                    output_files[mode]
+                )
+            )
+        ))
+        command_groups.append(commands)
+    if copy_modes:
+        # ストリームコピーは別コマンドにして、失敗しても再エンコードの出力を巻き込まないようにする
+        command_groups.append([(
+            "ffmpeg", "-progress", "pipe:1", "-nostats", "-y",
+            "-i", input_file,
+            *(
+                arg
+                for mode in copy_modes
+                for arg in ("-map", "0:v:0", "-map", "0:a:0?", "-c", "copy", "-movflags", "+faststart",
+                            output_files[mode])
+            )
+        )])
+
+    # バックグラウンドのイベントループにジョブを登録し、すぐにUIへ制御を戻す
+    output_paths = tuple(output_files.values())
+    active_outputs.update(output_paths)
+    update_progress(job_id, 0.0)
+    asyncio.run_coroutine_threadsafe(
+        encode_job(job_id, command_groups, duration, output_paths, passlogfile, use_nvenc and bool(encode_modes)),
+        encode_loop
+    )
 
 # ==============================
 # メインウィンドウの構築
 # ==============================
 root = TkinterDnD.Tk()
 root.title("FFmpeg MovieEncoder_v1.1.1")
+root.protocol("WM_DELETE_WINDOW", on_close)
 
 # 設定ファイルを読み込み、前回の保存先とNVENC設定を取得
 config = load_config()
 last_output_dir = config.get('last_output_dir', "")  # なければ空文字列
 default_nvenc = config.get('use_nvenc', False)
+default_force_reencode = config.get('force_reencode', False)
+default_nvenc_preset = config.get('nvenc_preset', DEFAULT_NVENC_PRESET)
+if default_nvenc_preset not in NVENC_PRESETS:
+    default_nvenc_preset = DEFAULT_NVENC_PRESET
+# ffprobeの結果キャッシュを復元（以降は config と同じ辞書を共有して保存する）
+probe_cache.update(config.get('probe_cache', {}))
+config['probe_cache'] = probe_cache
 
 # 入力ファイルの選択エリア
 tk.Label(root, text="入力ファイル:").grid(row=0, column=0, padx=5, pady=5, sticky="e")
@@ -248,21 +733,46 @@ output_dir_entry.grid(row=1, column=1, padx=5, pady=5)
 output_dir_entry.insert(0, last_output_dir)  # 前回保存したフォルダをセット
 tk.Button(root, text="出力先を選択", command=browse_output_dir).grid(row=1, column=2, padx=5, pady=5)
 
-# 出力設定（ラジオボタン）
-mode_var = tk.StringVar(value="360p")  # デフォルトは360p
+# 出力設定（チェックボックス、複数選択すると1回のデコードでまとめて出力する）
+mode_vars = {}
 frame = tk.LabelFrame(root, text="出力設定")
 frame.grid(row=2, column=0, columnspan=3, padx=5, pady=5, sticky="w")
-modes = [("360p", "360p"), ("480p", "480p"), ("720p", "720p"), ("9.5MB", "9.5MB")]
-for i, (text, mode) in enumerate(modes):
-    rb = tk.Radiobutton(frame, text=text, variable=mode_var, value=mode)
-    rb.grid(row=0, column=i, padx=5, pady=5)
+for i, mode in enumerate(MODES):
+    mode_vars[mode] = tk.BooleanVar(value=(mode == "360p"))  # デフォルトは360p
+    cb = tk.Checkbutton(frame, text=mode, variable=mode_vars[mode])
+    cb.grid(row=0, column=i, padx=5, pady=5)
 
-# NVENC使用チェックボックス
-use_nvenc_var = tk.BooleanVar(value=default_nvenc)
-nvenc_checkbox = tk.Checkbutton(root, text="NVENCを使用", variable=use_nvenc_var, command=toggle_nvenc)
-nvenc_checkbox.grid(row=3, column=0, columnspan=3, padx=5, pady=5)
+# NVENC使用チェックボックスとプリセット（FFmpegがNVENCに対応していない場合は無効化する）
+has_nvenc, has_fdk_aac = detect_encoders()
+nvenc_frame = tk.Frame(root)
+nvenc_frame.grid(row=3, column=0, columnspan=3, padx=5, pady=5)
+use_nvenc_var = tk.BooleanVar(value=default_nvenc and has_nvenc)
+nvenc_checkbox = tk.Checkbutton(nvenc_frame, text="NVENCを使用", variable=use_nvenc_var, command=toggle_nvenc)
+nvenc_checkbox.grid(row=0, column=0, padx=5)
+tk.Label(nvenc_frame, text="プリセット:").grid(row=0, column=1, padx=(10, 0))
+nvenc_preset_var = tk.StringVar(value=default_nvenc_preset)
+nvenc_preset_menu = tk.OptionMenu(nvenc_frame, nvenc_preset_var, *NVENC_PRESETS, command=change_nvenc_preset)
+nvenc_preset_menu.grid(row=0, column=2, padx=5)
+if not has_nvenc:
+    nvenc_checkbox.config(state=tk.DISABLED)
+    nvenc_preset_menu.config(state=tk.DISABLED)
+
+# 強制再エンコードチェックボックス（オフの場合、条件を満たす出力はストリームコピーする）
+force_reencode_var = tk.BooleanVar(value=default_force_reencode)
+force_reencode_checkbox = tk.Checkbutton(root, text="強制的に再エンコード", variable=force_reencode_var, command=toggle_force_reencode)
+force_reencode_checkbox.grid(row=4, column=0, columnspan=3, padx=5, pady=5)
 
 # 変換開始ボタン
-tk.Button(root, text="エンコード開始", command=run_ffmpeg).grid(row=4, column=1, pady=10)
+encode_button = tk.Button(root, text="エンコード開始", command=run_ffmpeg)
+encode_button.grid(row=5, column=1, pady=10)
+
+# 進捗表示
+progress_bar = ttk.Progressbar(root, length=350, maximum=100)
+progress_bar.grid(row=6, column=0, columnspan=3, padx=5, pady=5)
+status_label = tk.Label(root, text="待機中")
+status_label.grid(row=7, column=0, columnspan=3, padx=5, pady=(0, 10))
+
+# エンコード用のイベントループをバックグラウンドで起動
+threading.Thread(target=encode_loop.run_forever, daemon=True).start()
 
 root.mainloop()